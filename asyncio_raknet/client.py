@@ -1,12 +1,13 @@
 import asyncio
 
+from asyncio_raknet import linux
 from asyncio_raknet.packets import *
 from asyncio_raknet.protocol import Protocol
 
 
-async def connect(host, port, **kwargs):
+async def connect(host, port, timeout=10.0, idle_timeout=None, **kwargs):
     loop = asyncio.get_event_loop()
-    protocol = Protocol()
+    protocol = Protocol(timeout=timeout, idle_timeout=idle_timeout)
     await loop.create_datagram_endpoint(lambda: protocol, remote_addr=(host, port), **kwargs)
     return protocol
 
@@ -20,14 +21,25 @@ async def status(host, port, **kwargs):
     return packet.status
 
 
-async def login(host, port, **kwargs):
+async def login(host, port, mtus=(1492, 1200, 576), probe_timeout=2.0, **kwargs):
     protocol = await connect(host, port, **kwargs)
-    protocol.write(OpenConnectionRequest1(
-        mtu=protocol.mtu,
-        version=protocol.version))
+    linux.set_dont_fragment(protocol.transport.get_extra_info('socket'))
+
+    # Probe for the largest MTU the path carries
+    for mtu in mtus:
+        protocol.write(OpenConnectionRequest1(
+            mtu=mtu,
+            version=protocol.version))
+        try:
+            packet = await asyncio.wait_for(protocol.read(), probe_timeout)
+        except asyncio.TimeoutError:
+            continue
+        break
+    else:
+        protocol.transport.close()
+        raise TimeoutError("No reply to any MTU probe")
 
     while True:
-        packet = await protocol.read()
         if type(packet) is OpenConnectionReply1:
             protocol.mtu = packet.mtu
             protocol.write(OpenConnectionRequest2(
@@ -37,8 +49,10 @@ async def login(host, port, **kwargs):
         elif type(packet) is OpenConnectionReply2:
             protocol.mtu = packet.mtu
             protocol.online = True
+            protocol.schedule()
             break
         else:
             raise ValueError(packet)
+        packet = await protocol.read()
 
     return protocol
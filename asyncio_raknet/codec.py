@@ -0,0 +1,204 @@
+import itertools
+
+from asyncio_raknet.types import *
+
+
+class Field(object):
+    # Fixed-width fields have a struct format, and are merged with their
+    # neighbours into one Struct. Others unpack themselves from a view
+    __slots__ = ('fmt', 'decode', 'encode')
+
+    def __init__(self, fmt=None, decode=None, encode=None):
+        self.fmt = fmt
+        self.decode = decode
+        self.encode = encode
+
+    def unpack_from(self, view, offset):
+        raise NotImplementedError
+
+    def pack(self, value):
+        raise NotImplementedError
+
+
+class AddressField(Field):
+    __slots__ = ()
+
+    def unpack_from(self, view, offset):
+        return Address.unpack_from(view, offset)
+
+    def pack(self, value):
+        return value.pack()
+
+
+class AddressesField(Field):
+    __slots__ = ('count',)
+
+    def __init__(self, count):
+        super().__init__()
+        self.count = count
+
+    def unpack_from(self, view, offset):
+        addresses = []
+        for _ in range(self.count):
+            address, offset = Address.unpack_from(view, offset)
+            addresses.append(address)
+        return addresses, offset
+
+    def pack(self, value):
+        return b''.join(address.pack() for address in value)
+
+
+class BytesField(Field):
+    # Prefixed with a uint16 length
+    __slots__ = ()
+
+    def unpack_from(self, view, offset):
+        length = struct_uint16.unpack_from(view, offset)[0]
+        offset += 2
+        if offset + length > len(view):
+            raise Underrun()
+        return bytes(view[offset:offset + length]), offset + length
+
+    def pack(self, value):
+        return pack_uint16(len(value)) + value
+
+
+class RemainingField(Field):
+    __slots__ = ()
+
+    def unpack_from(self, view, offset):
+        return bytes(view[offset:]), len(view)
+
+    def pack(self, value):
+        return value
+
+
+class PaddingField(Field):
+    # Zero padding whose length gives a value, e.g. the MTU being probed
+    __slots__ = ('overhead',)
+
+    def __init__(self, overhead):
+        super().__init__()
+        self.overhead = overhead
+
+    def unpack_from(self, view, offset):
+        return len(view) - offset + self.overhead, len(view)
+
+    def pack(self, value):
+        return bytes(value - self.overhead)
+
+
+uint8 = Field('B')
+uint16 = Field('H')
+uint32 = Field('I')
+uint64 = Field('Q')
+boolean = Field('?')
+guid = Field('8s', decode=GUID, encode=lambda value: value.value)
+address = AddressField()
+addresses = AddressesField
+string = BytesField()
+remaining = RemainingField()
+padding = PaddingField
+magic_field = Field('16s')
+
+
+def compile_packet(cls):
+    # Generate unpack_from() and pack() for the declared fields, merging
+    # runs of fixed-width fields into single Structs
+    namespace = {'Underrun': Underrun, 'struct': struct, 'magic': magic}
+    fields = [('ident', uint8)] + [(name or 'magic', field) for name, field in cls.fields]
+    unpack_lines = []
+    pack_parts = []
+    values = []
+    run = []
+    locals_idx = itertools.count()
+
+    def add(prefix, obj):
+        name = '%s_%d' % (prefix, len(namespace))
+        namespace[name] = obj
+        return name
+
+    def flush():
+        if not run:
+            return
+        packer = struct.Struct('>' + ''.join(field.fmt for _, field in run))
+        packer_name = add('struct', packer)
+        targets = ['value_%d' % next(locals_idx) for _ in run]
+        unpack_lines.append('%s, = %s.unpack_from(view, offset)' % (', '.join(targets), packer_name))
+        unpack_lines.append('offset += %d' % packer.size)
+        args = []
+        for target, (name, field) in zip(targets, run):
+            if name == 'ident':
+                unpack_lines.append('assert %s == %d' % (target, cls.ident))
+                args.append('%d' % cls.ident)
+                continue
+            if field is magic_field:
+                unpack_lines.append('assert %s == magic' % target)
+                args.append('magic')
+                continue
+            if field.decode is not None:
+                unpack_lines.append('%s = %s(%s)' % (target, add('decode', field.decode), target))
+            values.append((name, target))
+            if field.encode is not None:
+                args.append('%s(self.%s)' % (add('encode', field.encode), name))
+            else:
+                args.append('self.%s' % name)
+        pack_parts.append('%s.pack(%s)' % (packer_name, ', '.join(args)))
+        del run[:]
+
+    for name, field in fields:
+        if field.fmt is not None:
+            run.append((name, field))
+            continue
+        flush()
+        field_name = add('field', field)
+        target = 'value_%d' % next(locals_idx)
+        unpack_lines.append('%s, offset = %s.unpack_from(view, offset)' % (target, field_name))
+        values.append((name, target))
+        pack_parts.append('%s.pack(self.%s)' % (field_name, name))
+    flush()
+
+    source = 'def unpack_from(cls, view):\n'
+    source += '    offset = 0\n'
+    source += '    try:\n'
+    source += ''.join('        %s\n' % line for line in unpack_lines)
+    source += '    except (struct.error, IndexError):\n'
+    source += '        raise Underrun()\n'
+    source += '    return cls(%s)\n' % ', '.join('%s=%s' % value for value in values)
+    source += '\n'
+    source += 'def pack(self):\n'
+    if len(pack_parts) == 1:
+        source += '    return %s\n' % pack_parts[0]
+    else:
+        source += '    return b"".join((%s))\n' % ', '.join(pack_parts)
+    source += '\n'
+    source += 'def __init__(self%s):\n' % ''.join(', ' + name for name, _ in values)
+    source += ''.join('    self.%s = %s\n' % (name, name) for name, _ in values) or '    pass\n'
+    exec(source, namespace)
+
+    cls.unpack_from = classmethod(namespace['unpack_from'])
+    cls.pack = namespace['pack']
+    if cls.__init__ is object.__init__:
+        cls.__init__ = namespace['__init__']
+
+
+class PacketType(type):
+    def __new__(mcs, name, bases, namespace):
+        # Slots come from the declared fields
+        if namespace.get('fields') is not None:
+            namespace['__slots__'] = tuple(name for name, _ in namespace['fields'] if name)
+        else:
+            namespace.setdefault('__slots__', ())
+        cls = super().__new__(mcs, name, bases, namespace)
+        if cls.fields is not None:
+            compile_packet(cls)
+        return cls
+
+
+class Packet(Serializable, metaclass=PacketType):
+    ident = None
+    fields = None
+
+    @classmethod
+    def unpack(cls, buff):
+        return cls.unpack_from(buff.read())
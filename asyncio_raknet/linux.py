@@ -0,0 +1,250 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import socket
+import struct
+import sys
+
+SOL_UDP = 17
+UDP_SEGMENT = 103
+gso_max_segments = 64
+gso_max_size = 65507
+max_batch = 1024
+sockaddr_size = 128
+SO_ATTACH_REUSEPORT_CBPF = 51
+SKF_NET_OFF = -0x100000
+IP_MTU_DISCOVER = 10
+IPV6_MTU_DISCOVER = 23
+PMTUDISC_DO = 2
+cmsg_header = struct.Struct('@Nii')
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [
+        ('iov_base', ctypes.c_void_p),
+        ('iov_len', ctypes.c_size_t)]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_name', ctypes.c_void_p),
+        ('msg_namelen', ctypes.c_uint32),
+        ('msg_iov', ctypes.POINTER(iovec)),
+        ('msg_iovlen', ctypes.c_size_t),
+        ('msg_control', ctypes.c_void_p),
+        ('msg_controllen', ctypes.c_size_t),
+        ('msg_flags', ctypes.c_int)]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_hdr', msghdr),
+        ('msg_len', ctypes.c_uint)]
+
+
+libc = None
+if sys.platform.startswith('linux'):
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int]
+        libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    except (OSError, AttributeError):
+        libc = None
+
+available = libc is not None
+
+
+def pack_sockaddr(addr):
+    host, port = addr[:2]
+    if ':' in host:
+        flowinfo, scope_id = addr[2:4] if len(addr) == 4 else (0, 0)
+        return struct.pack('=H', socket.AF_INET6) + struct.pack('>HI', port, flowinfo) + \
+               socket.inet_pton(socket.AF_INET6, host) + struct.pack('=I', scope_id)
+    else:
+        return struct.pack('=H', socket.AF_INET) + struct.pack('>H', port) + \
+               socket.inet_pton(socket.AF_INET, host) + b'\x00' * 8
+
+
+def unpack_sockaddr(name):
+    family = struct.unpack_from('=H', name)[0]
+    if family == socket.AF_INET6:
+        port, flowinfo = struct.unpack_from('>HI', name, 2)
+        scope_id = struct.unpack_from('=I', name, 24)[0]
+        return socket.inet_ntop(socket.AF_INET6, name[8:24]), port, flowinfo, scope_id
+    else:
+        port = struct.unpack_from('>H', name, 2)[0]
+        return socket.inet_ntop(socket.AF_INET, name[4:8]), port
+
+
+def pack_segment_cmsg(size):
+    # struct cmsghdr followed by a uint16 segment size, padded to CMSG_SPACE(2)
+    data = struct.pack('=H', size).ljust(ctypes.sizeof(ctypes.c_size_t), b'\x00')
+    return cmsg_header.pack(cmsg_header.size + 2, SOL_UDP, UDP_SEGMENT) + data
+
+
+def make_buffer(data):
+    return (ctypes.c_char * len(data)).from_buffer_copy(data)
+
+
+def attach_reuseport_cbpf(sock, count):
+    # Classic BPF: pick socket (source IPv4 address ^ source port) % count
+    program = [
+        (0xb1, 0, 0, SKF_NET_OFF),       # ldx 4 * ([net + 0] & 0xf)
+        (0x48, 0, 0, SKF_NET_OFF),       # ldh [x + net + 0]
+        (0x07, 0, 0, 0),                 # tax
+        (0x20, 0, 0, SKF_NET_OFF + 12),  # ld [net + 12]
+        (0xac, 0, 0, 0),                 # xor x
+        (0x94, 0, 0, count),             # mod #count
+        (0x16, 0, 0, 0)]                 # ret a
+    filters = make_buffer(b''.join(struct.pack('=HBBi', *insn) for insn in program))
+    fprog = struct.pack('@HP', len(program), ctypes.addressof(filters))
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_REUSEPORT_CBPF, fprog)
+
+
+def set_dont_fragment(sock):
+    # Oversized datagrams fail rather than being fragmented, so MTU probes mean something
+    if not sys.platform.startswith('linux'):
+        return False
+    if sock.family == socket.AF_INET6:
+        level, option = socket.IPPROTO_IPV6, IPV6_MTU_DISCOVER
+    else:
+        level, option = socket.IPPROTO_IP, IP_MTU_DISCOVER
+    try:
+        sock.setsockopt(level, option, PMTUDISC_DO)
+    except OSError:
+        return False
+    return True
+
+
+class Sender(object):
+    def __init__(self, sock, gso=True):
+        self.fileno = sock.fileno()
+        self.gso = gso
+        self.sockaddrs = {}
+
+    def sockaddr(self, addr):
+        sockaddr = self.sockaddrs.get(addr)
+        if sockaddr is None:
+            if len(self.sockaddrs) > 4096:
+                self.sockaddrs.clear()
+            sockaddr = self.sockaddrs[addr] = make_buffer(pack_sockaddr(addr))
+        return sockaddr
+
+    def group(self, datagrams):
+        # Split into messages; with GSO, runs of equal-sized datagrams to one
+        # peer become a single message (the last segment may be shorter)
+        messages = []
+        for data, addr in datagrams:
+            if self.gso and messages:
+                last = messages[-1]
+                if last[1] == addr and len(last[0]) < gso_max_segments and \
+                        len(data) <= last[2] and last[3] + len(data) <= gso_max_size and \
+                        len(last[0][-1]) == last[2]:
+                    last[0].append(data)
+                    last[3] += len(data)
+                    continue
+            messages.append([[data], addr, len(data), len(data)])
+        return messages
+
+    def send(self, datagrams):
+        # Returns the number of datagrams that were handed to the kernel
+        messages = self.group(datagrams)[:max_batch]
+        datagrams = datagrams[:sum(len(message[0]) for message in messages)]
+        count = len(messages)
+        buff = b''.join(data for message in messages for data in message[0])
+        base = ctypes.cast(ctypes.c_char_p(buff), ctypes.c_void_p).value
+        iovs = (iovec * count)()
+        hdrs = (mmsghdr * count)()
+        controls = []
+        offset = 0
+        for iov, hdr, (segments, addr, size, total) in zip(iovs, hdrs, messages):
+            iov.iov_base = base + offset
+            iov.iov_len = total
+            offset += total
+            sockaddr = self.sockaddr(addr)
+            msg = hdr.msg_hdr
+            msg.msg_name = ctypes.addressof(sockaddr)
+            msg.msg_namelen = ctypes.sizeof(sockaddr)
+            msg.msg_iov = ctypes.pointer(iov)
+            msg.msg_iovlen = 1
+            if len(segments) > 1:
+                control = make_buffer(pack_segment_cmsg(size))
+                controls.append(control)
+                msg.msg_control = ctypes.addressof(control)
+                msg.msg_controllen = ctypes.sizeof(control)
+
+        sent = libc.sendmmsg(self.fileno, hdrs, count, 0)
+        if sent < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return 0
+            if self.gso and err in (errno.EINVAL, errno.EIO, errno.ENOPROTOOPT, errno.EOPNOTSUPP):
+                self.gso = False
+                return self.send(datagrams)
+            raise OSError(err, os.strerror(err))
+        return sum(len(messages[idx][0]) for idx in range(sent))
+
+
+class Receiver(object):
+    def __init__(self, sock, count=64, size=2048):
+        # Read from a duplicate descriptor, as the loop won't watch a transport's own
+        self.socket = socket.fromfd(sock.fileno(), sock.family, sock.type)
+        self.count = count
+        self.size = size
+        self.buffers = bytearray(count * size)
+        self.names = bytearray(count * sockaddr_size)
+        self.view = memoryview(self.buffers)
+        self.used = count
+        self.addrs = {}
+
+        # Point one message header at each buffer and address slot, once
+        buffers = ctypes.addressof((ctypes.c_char * len(self.buffers)).from_buffer(self.buffers))
+        names = ctypes.addressof((ctypes.c_char * len(self.names)).from_buffer(self.names))
+        self.iovs = (iovec * count)()
+        self.hdrs = (mmsghdr * count)()
+        for idx, (iov, hdr) in enumerate(zip(self.iovs, self.hdrs)):
+            iov.iov_base = buffers + idx * size
+            iov.iov_len = size
+            hdr.msg_hdr.msg_iov = ctypes.pointer(iov)
+            hdr.msg_hdr.msg_iovlen = 1
+            hdr.msg_hdr.msg_name = names + idx * sockaddr_size
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def close(self):
+        self.socket.close()
+
+    def sockaddr(self, idx, length):
+        offset = idx * sockaddr_size
+        name = bytes(self.names[offset:offset + length])
+        addr = self.addrs.get(name)
+        if addr is None:
+            if len(self.addrs) > 4096:
+                self.addrs.clear()
+            addr = self.addrs[name] = unpack_sockaddr(name)
+        return addr
+
+    def receive(self):
+        # Returns (view, addr) pairs; views are only valid until the next call
+        for idx in range(self.used):
+            self.hdrs[idx].msg_hdr.msg_namelen = sockaddr_size
+        count = libc.recvmmsg(self.socket.fileno(), self.hdrs, self.count, socket.MSG_DONTWAIT, None)
+        if count < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                self.used = 0
+                return []
+            raise OSError(err, os.strerror(err))
+        self.used = count
+
+        datagrams = []
+        for idx in range(count):
+            hdr = self.hdrs[idx]
+            if hdr.msg_hdr.msg_flags & socket.MSG_TRUNC:
+                continue
+            offset = idx * self.size
+            addr = self.sockaddr(idx, hdr.msg_hdr.msg_namelen)
+            datagrams.append((self.view[offset:offset + hdr.msg_len], addr))
+        return datagrams
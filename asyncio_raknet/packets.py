@@ -1,35 +1,35 @@
-from asyncio_raknet.types import *
+from asyncio_raknet.codec import *
 
 """
 x   00 CONNECTED_PING
 x   01 UNCONNECTED_PING
 x   02 UNCONNECTED_PING_OPEN_CONNECTIONS
 x   03 CONNECTED_PONG
-    04 DETECT_LOST_CONNECTIONS
+x   04 DETECT_LOST_CONNECTIONS
 x   05 OPEN_CONNECTION_REQUEST_1
 x   06 OPEN_CONNECTION_REPLY_1
 x   07 OPEN_CONNECTION_REQUEST_2
 x   08 OPEN_CONNECTION_REPLY_2
 x   09 CONNECTION_REQUEST
-    0a REMOTE_SYSTEM_REQUIRES_PUBLIC_KEY
-    0b OUR_SYSTEM_REQUIRES_SECURITY
-    0c PUBLIC_KEY_MISMATCH
+x   0a REMOTE_SYSTEM_REQUIRES_PUBLIC_KEY
+x   0b OUR_SYSTEM_REQUIRES_SECURITY
+x   0c PUBLIC_KEY_MISMATCH
     0d OUT_OF_BAND_INTERNAL
     0e SND_RECEIPT_ACKED
     0f SND_RECEIPT_LOSS
 x   10 CONNECTION_REQUEST_ACCEPTED
-    11 CONNECTION_ATTEMPT_FAILED
-    12 ALREADY_CONNECTED
+x   11 CONNECTION_ATTEMPT_FAILED
+x   12 ALREADY_CONNECTED
 x   13 NEW_INCOMING_CONNECTION
-    14 NO_FREE_INCOMING_CONNECTIONS
+x   14 NO_FREE_INCOMING_CONNECTIONS
 x   15 DISCONNECTION_NOTIFICATION
-    16 CONNECTION_LOST
-    17 CONNECTION_BANNED
-    18 INVALID_PASSWORD
+x   16 CONNECTION_LOST
+x   17 CONNECTION_BANNED
+x   18 INVALID_PASSWORD
 x   19 INCOMPATIBLE_PROTOCOL_VERSION
-    1a IP_RECENTLY_CONNECTED
-    1b TIMESTAMP
-    1c UNCONNECTED_PONG
+x   1a IP_RECENTLY_CONNECTED
+x   1b TIMESTAMP
+x   1c UNCONNECTED_PONG
     1d ADVERTISE_SYSTEM
     1e DOWNLOAD_PROGRESS
 """
@@ -47,6 +47,12 @@ reliability_types = [
     (1, 1, 1, 1),  # 7: Receipt + Reliable Sequenced
 ]
 
+UNRELIABLE = 0
+UNRELIABLE_SEQUENCED = 1
+RELIABLE = 2
+RELIABLE_ORDERED = 3
+RELIABLE_SEQUENCED = 4
+
 
 packet_types = {}
 
@@ -57,40 +63,24 @@ def packet_type(cls):
 
 
 @packet_type
-class ConnectedPing(Serializable):
+class ConnectedPing(Packet):
     ident = 0x00
-
-    def __init__(self, local_time):
-        self.local_time = local_time
-
-    @classmethod
-    def unpack(cls, buff):
-        assert unpack_uint8(buff) == cls.ident
-        return cls(unpack_uint64(buff))
-
-    def pack(self):
-        return pack_uint8(self.ident) + pack_uint64(self.local_time)
+    fields = [
+        ('local_time', uint64)]
 
 
 @packet_type
-class UnconnectedPing(Serializable):
+class UnconnectedPing(Packet):
     ident = 0x01
+    fields = [
+        ('local_time', uint64),
+        (None, magic_field),
+        ('guid', guid)]
 
     def __init__(self, guid, local_time):
         self.guid = guid
         self.local_time = local_time
 
-    @classmethod
-    def unpack(cls, buff):
-        assert unpack_uint8(buff) == cls.ident
-        local_time = unpack_uint64(buff)
-        assert buff.read(16) == magic
-        guid = GUID.unpack(buff)
-        return cls(guid, local_time)
-
-    def pack(self):
-        return pack_uint8(self.ident) + pack_uint64(self.local_time) + magic + self.guid.pack()
-
 
 @packet_type
 class UnconnectedPingOpenConnections(UnconnectedPing):
@@ -98,95 +88,71 @@ class UnconnectedPingOpenConnections(UnconnectedPing):
 
 
 @packet_type
-class ConnectedPong(Serializable):
+class ConnectedPong(Packet):
     ident = 0x03
+    fields = [
+        ('remote_time', uint64),
+        ('local_time', uint64)]
 
-    def __init__(self, remote_time, local_time):
-        self.remote_time = remote_time
-        self.local_time = local_time
 
-    @classmethod
-    def unpack(cls, buff):
-        assert unpack_uint8(buff) == cls.ident
-        remote_time = unpack_uint64(buff)
-        local_time = unpack_uint64(buff)
-        return cls(remote_time, local_time)
-
-    def pack(self):
-        return pack_uint8(self.ident) + \
-               pack_uint64(self.remote_time) + \
-               pack_uint64(self.local_time)
+@packet_type
+class DetectLostConnections(Packet):
+    ident = 0x04
+    fields = []
 
 
 @packet_type
-class OpenConnectionRequest1(Serializable):
+class OpenConnectionRequest1(Packet):
     ident = 0x05
+    fields = [
+        (None, magic_field),
+        ('version', uint8),
+        ('mtu', padding(46))]
 
     def __init__(self, mtu, version):
         self.mtu = mtu
         self.version = version
 
-    @classmethod
-    def unpack(cls, buff):
-        assert unpack_uint8(buff) == cls.ident
-        assert buff.read(16) == magic
-        version = unpack_uint8(buff)
-        mtu = len(buff.read()) + 46
-        return cls(mtu, version)
-
-    def pack(self):
-        return pack_uint8(self.ident) + magic + pack_uint8(self.version) + b'\x00' * (self.mtu - 46)
-
 
 @packet_type
-class OpenConnectionReply1(Serializable):
+class OpenConnectionReply1(Packet):
     ident = 0x06
+    fields = [
+        (None, magic_field),
+        ('guid', guid),
+        ('security', boolean),
+        ('mtu', uint16)]
 
     def __init__(self, guid, mtu, security):
         self.guid = guid
         self.mtu = mtu
         self.security = security
 
-    @classmethod
-    def unpack(cls, buff):
-        assert unpack_uint8(buff) == cls.ident
-        assert buff.read(16) == magic
-        guid = GUID.unpack(buff)
-        security = unpack_bool(buff)
-        mtu = unpack_uint16(buff)
-        return cls(guid, mtu, security)
-
-    def pack(self):
-        return pack_uint8(self.ident) + magic + self.guid.pack() + \
-               pack_bool(self.security) + pack_uint16(self.mtu)
-
 
 @packet_type
-class OpenConnectionRequest2(Serializable):
+class OpenConnectionRequest2(Packet):
     ident = 0x07
+    fields = [
+        (None, magic_field),
+        ('remote_address', address),
+        ('mtu', uint16),
+        ('guid', guid)]
 
     def __init__(self, guid, mtu, remote_address):
         self.guid = guid
         self.mtu = mtu
         self.remote_address = remote_address
 
-    @classmethod
-    def unpack(cls, buff):
-        assert unpack_uint8(buff) == cls.ident
-        assert buff.read(16) == magic
-        remote_address = Address.unpack(buff)
-        mtu = unpack_uint16(buff)
-        guid = GUID.unpack(buff)
-        return cls(guid, mtu, remote_address)
-
-    def pack(self):
-        return pack_uint8(self.ident) + magic + self.remote_address.pack() + \
-               pack_uint16(self.mtu) + self.guid.pack()
-
 
 @packet_type
-class OpenConnectionReply2(Serializable):
+class OpenConnectionReply2(Packet):
     ident = 0x08
+    fields = [
+        (None, magic_field),
+        ('guid', guid),
+        ('remote_address', address),
+        ('mtu', uint16),
+        ('encryption', boolean)]
 
     def __init__(self, guid, mtu, remote_address, encryption):
         self.guid = guid
@@ -194,46 +160,43 @@ class OpenConnectionReply2(Serializable):
         self.remote_address = remote_address
         self.encryption = encryption
 
-    @classmethod
-    def unpack(cls, buff):
-        assert unpack_uint8(buff) == cls.ident
-        assert buff.read(16) == magic
-        guid = GUID.unpack(buff)
-        remote_address = Address.unpack(buff)
-        mtu = unpack_uint16(buff)
-        encryption = unpack_bool(buff)
-        return cls(guid, mtu, remote_address, encryption)
 
-    def pack(self):
-        return pack_uint8(self.ident) + magic + self.guid.pack() + \
-               self.remote_address.pack() + pack_uint16(self.mtu) + pack_bool(self.encryption)
+@packet_type
+class ConnectionRequest(Packet):
+    ident = 0x09
+    fields = [
+        ('guid', guid),
+        ('local_time', uint64),
+        ('security', boolean)]
 
 
 @packet_type
-class ConnectionRequest(Serializable):
-    ident = 0x09
+class RemoteSystemRequiresPublicKey(Packet):
+    ident = 0x0a
+    fields = []
 
-    def __init__(self, guid, local_time, security):
-        self.guid = guid
-        self.local_time = local_time
-        self.security = security
 
-    @classmethod
-    def unpack(cls, buff):
-        assert unpack_uint8(buff) == cls.ident
-        guid = GUID.unpack(buff)
-        local_time = unpack_uint64(buff)
-        security = unpack_bool(buff)
-        return cls(guid, local_time, security)
+@packet_type
+class OurSystemRequiresSecurity(Packet):
+    ident = 0x0b
+    fields = []
 
-    def pack(self):
-        return pack_uint8(self.ident) + self.guid.pack() + \
-               pack_uint64(self.local_time) + pack_bool(self.security)
+
+@packet_type
+class PublicKeyMismatch(Packet):
+    ident = 0x0c
+    fields = []
 
 
 @packet_type
-class ConnectionRequestAccepted(Serializable):
+class ConnectionRequestAccepted(Packet):
     ident = 0x10
+    fields = [
+        ('remote_address', address),
+        ('system_idx', uint16),
+        ('internal_addresses', addresses(20)),
+        ('remote_time', uint64),
+        ('local_time', uint64)]
 
     def __init__(self, remote_time, local_time, remote_address, internal_addresses, system_idx):
         self.remote_time = remote_time
@@ -242,106 +205,111 @@ class ConnectionRequestAccepted(Serializable):
         self.internal_addresses = internal_addresses
         self.system_idx = system_idx
 
-    @classmethod
-    def unpack(cls, buff):
-        assert unpack_uint8(buff) == cls.ident
-        remote_address = Address.unpack(buff)
-        system_idx = unpack_uint16(buff)
-        internal_addresses = [Address.unpack(buff) for _ in range(20)]
-        remote_time = unpack_uint64(buff)
-        local_time = unpack_uint64(buff)
-        return cls(remote_time, local_time, remote_address, internal_addresses, system_idx)
 
-    def pack(self):
-        return pack_uint8(self.ident) + self.remote_address.pack() + pack_uint16(self.system_idx) + \
-               b''.join(address.pack() for address in self.internal_addresses) + \
-               pack_uint64(self.remote_time) + pack_uint64(self.local_time)
+@packet_type
+class ConnectionAttemptFailed(Packet):
+    ident = 0x11
+    fields = []
+
+
+@packet_type
+class AlreadyConnected(Packet):
+    ident = 0x12
+    fields = [
+        (None, magic_field),
+        ('guid', guid)]
 
 
 @packet_type
-class NewIncomingConnection(Serializable):
+class NewIncomingConnection(Packet):
     ident = 0x13
+    fields = [
+        ('remote_address', address),
+        ('internal_addresses', addresses(10))]
 
-    def __init__(self, remote_address, internal_addresses):
-        self.remote_address = remote_address
-        self.internal_addresses = internal_addresses
 
-    @classmethod
-    def unpack(cls, buff):
-        assert unpack_uint8(buff) == cls.ident
-        remote_address = Address.unpack(buff)
-        internal_addresses = [Address.unpack(buff) for _ in range(10)]
-        return cls(remote_address, internal_addresses)
-    
-    def pack(self):
-        return pack_uint8(self.ident) + self.remote_address.pack() + \
-               b"".join(address.pack() for address in self.internal_addresses)
+@packet_type
+class NoFreeIncomingConnections(Packet):
+    ident = 0x14
+    fields = [
+        (None, magic_field),
+        ('guid', guid)]
 
 
 @packet_type
-class DisconnectionNotification(Serializable):
+class DisconnectionNotification(Packet):
     ident = 0x15
+    fields = []
 
-    @classmethod
-    def unpack(cls, buff):
-        return cls()
 
-    def pack(self):
-        return b''
+@packet_type
+class ConnectionLost(Packet):
+    ident = 0x16
+    fields = []
+
+
+@packet_type
+class ConnectionBanned(Packet):
+    ident = 0x17
+    fields = [
+        (None, magic_field),
+        ('guid', guid)]
 
 
 @packet_type
-class IncompatibleProtocolVersion(Serializable):
+class InvalidPassword(Packet):
+    ident = 0x18
+    fields = []
+
+
+@packet_type
+class IncompatibleProtocolVersion(Packet):
     ident = 0x19
+    fields = [
+        ('version', uint8),
+        (None, magic_field),
+        ('guid', guid)]
 
     def __init__(self, guid, version):
         self.guid = guid
         self.version = version
 
-    @classmethod
-    def unpack(cls, buff):
-        assert unpack_uint8(buff) == cls.ident
-        version = unpack_uint8(buff)
-        assert buff.read(16) == magic
-        guid = GUID.unpack(buff)
-        return cls(guid, version)
 
-    def pack(self):
-        return pack_uint8(self.ident) + pack_uint8(self.version) + \
-               magic + self.guid.pack()
+@packet_type
+class IPRecentlyConnected(Packet):
+    ident = 0x1a
+    fields = [
+        (None, magic_field),
+        ('guid', guid)]
+
+
+@packet_type
+class Timestamp(Packet):
+    ident = 0x1b
+    fields = [
+        ('time', uint64),
+        ('payload', remaining)]
 
 
 @packet_type
-class UnconnectedPong(Serializable):
+class UnconnectedPong(Packet):
     ident = 0x1c
+    fields = [
+        ('remote_time', uint64),
+        ('guid', guid),
+        (None, magic_field),
+        ('status', string)]
 
     def __init__(self, guid, remote_time, status):
         self.guid = guid
         self.remote_time = remote_time
         self.status = status
 
-    @classmethod
-    def unpack(cls, buff):
-        assert unpack_uint8(buff) == cls.ident
-        remote_time = unpack_uint64(buff)
-        guid = GUID.unpack(buff)
-        assert buff.read(16) == magic
-        length = unpack_uint16(buff)
-        status = buff.read(length)
-        return cls(guid, remote_time, status)
-
-    def pack(self):
-        return pack_uint8(self.ident) + \
-               pack_uint64(self.remote_time) + \
-               self.guid.pack() + \
-               magic + \
-               pack_uint16(len(self.status)) + \
-               self.status
-
 
 @packet_type
 class Game(Serializable):
     ident = 0xfe
+    __slots__ = ('payload',)
 
     def __init__(self, payload):
         self.payload = payload
@@ -357,86 +325,141 @@ class Game(Serializable):
 @packet_type
 class ACK(Serializable):
     ident = 0xc0
-
-    def __init__(self, indices):
-        self.indices = indices
+    header_size = 3
+    __slots__ = ('ranges',)
+
+    def __init__(self, ranges):
+        # Inclusive (start, end) pairs of frame set indices
+        self.ranges = ranges
+
+    @staticmethod
+    def range_size(start, end):
+        return 4 if start == end else 7
+
+    @staticmethod
+    def collapse(indices):
+        # Collapse sorted indices into ranges
+        ranges = []
+        for idx in indices:
+            if ranges and ranges[-1][1] >= idx - 1:
+                ranges[-1] = (ranges[-1][0], idx)
+            else:
+                ranges.append((idx, idx))
+        return ranges
 
     @classmethod
     def unpack(cls, buff):
         assert unpack_uint8(buff) == cls.ident
-        indices = []
+        ranges = []
         for _ in range(unpack_uint16(buff)):
             single = unpack_bool(buff)
-            if single:
-                indices.append(unpack_uint24le(buff))
-            else:
-                indices.extend(range(unpack_uint24le(buff),
-                                     unpack_uint24le(buff)))
-        return cls(indices)
+            start = unpack_uint24le(buff)
+            end = start if single else unpack_uint24le(buff)
+            ranges.append((start, end))
+        return cls(ranges)
 
     def pack(self):
-        entries = []
-        for idx in self.indices:
-            if not entries or entries[-1][-1] != (idx - 1):
-                entries.append([])
-            entries[-1].append(idx)
-
-        out = pack_uint8(self.ident)
-        out += pack_uint16(len(entries))
-        for entry in entries:
-            out += pack_bool(len(entry) == 1)
-            out += pack_uint24le(entry[0])
-            if len(entry) != 1:
-                out += pack_uint24le(entry[-1])
-        return out
+        out = [pack_uint8(self.ident), pack_uint16(len(self.ranges))]
+        for start, end in self.ranges:
+            out.append(pack_bool(start == end))
+            out.append(pack_uint24le(start))
+            if start != end:
+                out.append(pack_uint24le(end))
+        return b''.join(out)
 
 
 @packet_type
 class NACK(ACK):
     ident = 0xa0
+    __slots__ = ()
+
+
+frame_header = struct.Struct('>BH')
+frame_fragment = struct.Struct('>IHI')
 
 
 @packet_type
 class FrameSet(Serializable):
     ident = 0x88
+    header_size = 4
+    __slots__ = ('idx', 'frames')
 
     def __init__(self, idx, frames):
         self.idx = idx
         self.frames = frames
 
+    @property
+    def size(self):
+        return self.header_size + sum(frame.size for frame in self.frames)
+
     def pack(self):
-        out = b'\x88' + pack_uint24le(self.idx)
+        buff = bytearray(self.size)
+        self.pack_into(buff)
+        return bytes(buff)
+
+    def pack_into(self, buff, offset=0):
+        buff[offset] = self.ident
+        buff[offset + 1:offset + 4] = pack_uint24le(self.idx)
+        offset += self.header_size
         for frame in self.frames:
-            out += frame.pack()
-        return out
+            offset = frame.pack_into(buff, offset)
+        return offset
 
     @classmethod
     def unpack(cls, buff):
-        unpack_uint8(buff)
-        idx = unpack_uint24le(buff)
+        return cls.unpack_from(memoryview(buff.read()))
+
+    @classmethod
+    def unpack_from(cls, view):
+        idx = unpack_uint24le_from(view, 1)
         frames = []
-        while True:
+        offset = 4
+        end = len(view)
+        while offset < end:
             try:
-                frames.append(Frame.unpack(buff))
+                frame, offset = Frame.unpack_from(view, offset)
             except Underrun:
                 break
+            frames.append(frame)
         return cls(idx, frames)
 
 
 class Frame(Serializable):
+    __slots__ = ('payload', 'reliable_idx', 'sequence_idx', 'order_idx', 'order_chan',
+                 'fragment_idx', 'fragment_chan', 'fragment_count', 'header',
+                 'deadline', 'sent', 'frame_set_idx', 'acked')
+
     def __init__(self, payload, reliable_idx=None, order_idx=None,
-                 fragment_idx=None, fragment_count=None, fragment_chan=None):
+                 fragment_idx=None, fragment_count=None, fragment_chan=None, order_chan=0,
+                 sequence_idx=None):
         self.payload = payload
         self.reliable_idx = reliable_idx
+        self.sequence_idx = sequence_idx
         self.order_idx = order_idx
+        self.order_chan = order_chan
         self.fragment_idx = fragment_idx
         self.fragment_chan = fragment_chan
         self.fragment_count = fragment_count
+        self.header = None
+
+        # Send state, while queued or awaiting acknowledgement
+        self.deadline = None
+        self.sent = None
+        self.frame_set_idx = None
+        self.acked = False
+
+    @property
+    def size(self):
+        return len(self.pack_header()) + len(self.payload)
 
     @property
     def reliable(self):
         return self.reliable_idx is not None
 
+    @property
+    def sequenced(self):
+        return self.sequence_idx is not None
+
     @property
     def ordered(self):
         return self.order_idx is not None
@@ -446,59 +469,80 @@ class Frame(Serializable):
         return self.fragment_idx is not None
 
     @classmethod
-    def from_fragments(cls, fragments):
-        return cls(
-            payload=b"".join(fragment.payload for fragment in fragments),
-            reliable_idx=fragments[0].reliable_idx,
-            order_idx=fragments[0].order_idx)
-
-    @classmethod
-    def unpack(cls, buff):
-        flags = unpack_uint8(buff)
-        length = unpack_uint16(buff) >> 3
-
-        # Load flags
-        receipt, reliable, sequenced, ordered = reliability_types[flags >> 5]
-        fragmented = flags & (1 << 4)
-        assert not sequenced
-        assert not receipt
-
-        # Load optional fields
-        reliable_idx = None
-        order_idx = None
-        fragment_idx = None
-        fragment_chan = None
-        fragment_count = None
-        if reliable:
-            reliable_idx = unpack_uint24le(buff)
-        if ordered:
-            order_idx = unpack_uint24le(buff)
-            order_chan = unpack_uint8(buff)
-            assert order_chan == 0
-        if fragmented:
-            fragment_count = unpack_uint32(buff)
-            fragment_chan = unpack_uint16(buff)
-            fragment_idx = unpack_uint32(buff)
-
-        # Load payload
-        payload = buff.read(length)
-
-        return cls(payload, reliable_idx, order_idx, fragment_idx, fragment_count, fragment_chan)
+    def unpack_from(cls, view, offset):
+        try:
+            flags, length = frame_header.unpack_from(view, offset)
+            offset += 3
+
+            # Load flags
+            receipt, reliable, sequenced, ordered = reliability_types[flags >> 5]
+            fragmented = flags & (1 << 4)
+            assert not receipt
+
+            # Load optional fields
+            reliable_idx = None
+            sequence_idx = None
+            order_idx = None
+            order_chan = 0
+            fragment_idx = None
+            fragment_chan = None
+            fragment_count = None
+            if reliable:
+                reliable_idx = unpack_uint24le_from(view, offset)
+                offset += 3
+            if sequenced:
+                sequence_idx = unpack_uint24le_from(view, offset)
+                offset += 3
+            if ordered:
+                order_idx = unpack_uint24le_from(view, offset)
+                order_chan = view[offset + 3]
+                assert order_chan < 32
+                offset += 4
+            if fragmented:
+                fragment_count, fragment_chan, fragment_idx = frame_fragment.unpack_from(view, offset)
+                offset += 10
+        except (struct.error, IndexError):
+            raise Underrun()
+
+        # Load payload as a view into the datagram
+        end = offset + ((length + 7) >> 3)
+        if end > len(view):
+            raise Underrun()
+        payload = view[offset:end]
+
+        return cls(payload, reliable_idx, order_idx, fragment_idx, fragment_count, fragment_chan, order_chan,
+                   sequence_idx), end
+
+    @staticmethod
+    def header_length(reliable, sequenced, ordered, fragmented):
+        return frame_header.size + 3 * reliable + 3 * sequenced + 4 * ordered + \
+            frame_fragment.size * fragmented
+
+    def pack_header(self):
+        if self.header is None:
+            flags = 0
+            flags |= reliability_types.index((0, self.reliable, self.sequenced, self.ordered)) << 5
+            flags |= int(self.fragmented) << 4
+            data = frame_header.pack(flags, 8 * len(self.payload))
+            if self.reliable:
+                data += pack_uint24le(self.reliable_idx)
+            if self.sequenced:
+                data += pack_uint24le(self.sequence_idx)
+            if self.ordered:
+                data += pack_uint24le(self.order_idx)
+                data += pack_uint8(self.order_chan)
+            if self.fragmented:
+                data += frame_fragment.pack(self.fragment_count, self.fragment_chan, self.fragment_idx)
+            self.header = data
+        return self.header
 
     def pack(self):
-        flags = 0
-        flags |= reliability_types.index((0, self.reliable, 0, self.ordered)) << 5
-        flags |= int(self.fragmented) << 4
-        data = bytes([flags])
-        data += pack_uint16(8 * len(self.payload))
-        if self.reliable:
-            data += pack_uint24le(self.reliable_idx)
-        if self.ordered:
-            data += pack_uint24le(self.order_idx)
-            data += b'\x00'  # channel
-        if self.fragmented:
-            data += pack_uint32(self.fragment_count)
-            data += pack_uint16(self.fragment_chan)
-            data += pack_uint32(self.fragment_idx)
-        data += self.payload
-        return data
+        return self.pack_header() + bytes(self.payload)
+
+    def pack_into(self, buff, offset):
+        header = self.pack_header()
+        end = offset + len(header)
+        buff[offset:end] = header
+        offset, end = end, end + len(self.payload)
+        buff[offset:end] = self.payload
+        return end
@@ -1,46 +1,260 @@
 import asyncio
+import bisect
 import collections
-import io
+import heapq
+import itertools
+import math
 
 from asyncio_raknet.packets import *
 
 
+class Disconnected(ConnectionResetError):
+    # The peer closed the session gracefully
+    pass
+
+
 class Task(object):
-    ticks = None
-    retries = None
+    __slots__ = ('obj', 'interval', 'retries', 'deadline')
 
-    def __init__(self, obj, ticks, retries):
+    def __init__(self, obj, interval, retries):
         assert obj is not None
         self.obj = obj
-        self.max_ticks = ticks
-        self.max_retries = retries
-        self.reset()
+        self.interval = interval
+        self.retries = retries
+        self.deadline = None
 
     @property
     def alive(self):
         return self.retries >= 0
 
-    @property
-    def active(self):
-        return self.alive and self.ticks == 0
-
-    def reset(self):
-        self.ticks = 0
-        self.retries = self.max_retries
+    def due(self, now):
+        return self.deadline is None or self.deadline <= now
+
+
+class Scheduler(object):
+    def __init__(self, interval=0.05):
+        self.loop = asyncio.get_event_loop()
+        self.interval = interval
+        self.current = 0
+        self.scheduled = {}
+        self.timers = []
+        self.timer_idx = itertools.count()
+        self.handle = None
+        self.handle_tick = None
+
+    def schedule(self, protocol, when):
+        # Round up to a whole tick so that sessions share wakeups
+        tick = max(math.ceil(when / self.interval), self.current + 1)
+        if self.scheduled.get(protocol, tick + 1) <= tick:
+            return
+        self.scheduled[protocol] = tick
+        heapq.heappush(self.timers, (tick, next(self.timer_idx), protocol))
+        if self.handle is None or tick < self.handle_tick:
+            self.wake(tick)
+
+    def wake(self, tick):
+        if self.handle is not None:
+            self.handle.cancel()
+        self.handle = self.loop.call_at(tick * self.interval, self.run)
+        self.handle_tick = tick
+
+    def run(self):
+        self.handle = None
+        self.current = round(self.loop.time() / self.interval)
+        now = self.current * self.interval
+        try:
+            while self.timers and self.timers[0][0] <= self.current:
+                tick, _, protocol = heapq.heappop(self.timers)
+                if self.scheduled.get(protocol) != tick:
+                    continue
+                del self.scheduled[protocol]
+                if protocol.transport.is_closing():
+                    continue
+
+                # One failing session mustn't stop the others being ticked
+                try:
+                    protocol.tick(now)
+                except Exception as exc:
+                    self.loop.call_exception_handler({
+                        'message': 'Exception in session tick',
+                        'exception': exc,
+                        'protocol': protocol,
+                    })
+        finally:
+            if self.timers and self.handle is None:
+                self.wake(self.timers[0][0])
+
+    def cancel(self, protocol):
+        self.scheduled.pop(protocol, None)
+
+    def close(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        self.scheduled.clear()
+        self.timers.clear()
+
+
+class SplitPacket(object):
+    def __init__(self, frame, deadline):
+        # Keep the header fields, but not the fragment's payload
+        self.frame = Frame(
+            payload=None,
+            reliable_idx=frame.reliable_idx,
+            order_idx=frame.order_idx,
+            order_chan=frame.order_chan,
+            sequence_idx=frame.sequence_idx)
+        self.count = frame.fragment_count
+        self.deadline = deadline
+        self.received = 0
+        self.arrived = None
+        self.buffer = None
+        self.stride = None
+        self.length = None
+        self.tail = None
+        self.size = 0
+
+
+class Reassembler(object):
+    # Reassembles split packets in place, within per-session and overall
+    # byte limits. May be shared between sessions, like the scheduler
+    def __init__(self, limit=128 * 1024 * 1024, session_limit=8 * 1024 * 1024, timeout=30.0):
+        self.limit = limit
+        self.session_limit = session_limit
+        self.timeout = timeout
+        self.size = 0
+        self.sessions = {}
+        self.session_sizes = {}
+
+    def reserve(self, protocol, split_packet, size):
+        session_size = self.session_sizes.get(protocol, 0)
+        if session_size + size > self.session_limit:
+            raise BufferError("Split packet exceeds session reassembly limit")
+        if self.size + size > self.limit:
+            raise BufferError("Split packet exceeds reassembly limit")
+        split_packet.size += size
+        self.session_sizes[protocol] = session_size + size
+        self.size += size
+
+    def release(self, protocol, split_packet, size):
+        split_packet.size -= size
+        self.session_sizes[protocol] -= size
+        self.size -= size
+
+    def remove(self, protocol, fragment_chan):
+        split_packet = self.sessions[protocol].pop(fragment_chan)
+        self.release(protocol, split_packet, split_packet.size)
+
+    def add(self, protocol, frame, now):
+        # Returns the reassembled frame once every fragment has arrived
+        split_packets = self.sessions.setdefault(protocol, {})
+        split_packet = split_packets.get(frame.fragment_chan)
+        if split_packet is None:
+            self.expire(protocol, now)
+            split_packet = split_packets[frame.fragment_chan] = SplitPacket(frame, now + self.timeout)
+
+        count = split_packet.count
+        fragment_idx = frame.fragment_idx
+        if frame.fragment_count != count or fragment_idx >= count:
+            self.remove(protocol, frame.fragment_chan)
+            return None
+
+        # Every fragment but the last has the same size, which tells us
+        # where each one goes. Hold on to the last until we know that
+        payload = frame.payload
+        if split_packet.buffer is None:
+            if fragment_idx == count - 1:
+                if split_packet.tail is None:
+                    self.reserve(protocol, split_packet, len(payload))
+                    split_packet.tail = bytes(payload)
+                    split_packet.length = len(payload)
+                    split_packet.received = 1
+            elif not payload:
+                self.remove(protocol, frame.fragment_chan)
+                return None
+            else:
+                # The buffer, plus a byte per fragment to mark its arrival
+                stride = len(payload)
+                self.reserve(protocol, split_packet, count * (stride + 1))
+                split_packet.stride = stride
+                split_packet.buffer = bytearray(count * stride)
+                split_packet.arrived = bytearray(count)
+                if split_packet.tail is not None:
+                    tail, split_packet.tail = split_packet.tail, None
+                    self.release(protocol, split_packet, len(tail))
+                    if len(tail) > stride:
+                        self.remove(protocol, frame.fragment_chan)
+                        return None
+                    offset = (count - 1) * stride
+                    split_packet.buffer[offset:offset + len(tail)] = tail
+                    split_packet.arrived[count - 1] = 1
+
+        if split_packet.buffer is not None and not split_packet.arrived[fragment_idx]:
+            if fragment_idx == count - 1:
+                if len(payload) > split_packet.stride:
+                    self.remove(protocol, frame.fragment_chan)
+                    return None
+                split_packet.length = len(payload)
+            elif len(payload) != split_packet.stride:
+                self.remove(protocol, frame.fragment_chan)
+                return None
+            offset = fragment_idx * split_packet.stride
+            split_packet.buffer[offset:offset + len(payload)] = payload
+            split_packet.arrived[fragment_idx] = 1
+            split_packet.received += 1
+        if split_packet.received != count:
+            return None
+
+        # Trim the short last fragment's slack
+        self.remove(protocol, frame.fragment_chan)
+        if split_packet.buffer is None:
+            payload = split_packet.tail
+        else:
+            payload = split_packet.buffer
+            del payload[(count - 1) * split_packet.stride + split_packet.length:]
+        frame = split_packet.frame
+        frame.payload = payload
+        return frame
 
-    def stop(self):
-        self.retries = -1
+    def expire(self, protocol, now):
+        split_packets = self.sessions.get(protocol, {})
+        for fragment_chan, split_packet in list(split_packets.items()):
+            if split_packet.deadline <= now:
+                self.remove(protocol, fragment_chan)
 
-    def tick(self):
-        self.ticks -= 1
-        if self.ticks == -1:
-            self.ticks += self.max_ticks
-            self.retries -= 1
+    def discard(self, protocol):
+        for fragment_chan in list(self.sessions.get(protocol, ())):
+            self.remove(protocol, fragment_chan)
+        self.sessions.pop(protocol, None)
+        self.session_sizes.pop(protocol, None)
 
 
 class Protocol(asyncio.DatagramProtocol):
-    def __init__(self):
+    min_rto = 0.2
+    max_rto = 10.0
+    min_cwnd = 2
+    max_cwnd = 2048
+    high_water = 1024 * 1024
+    low_water = 256 * 1024
+    read_limit = 1024
+    keepalive_interval = 2.0
+
+    def __init__(self, scheduler=None, timeout=10.0, reassembler=None, idle_timeout=None):
         super().__init__()
+        self.loop = asyncio.get_event_loop()
+        self.scheduler = scheduler or Scheduler()
+        self.reassembler = reassembler or Reassembler()
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.exception = None
+        self.srtt = None
+        self.rttvar = None
+        self.rto = 1.0
+        self.backoff_time = 0.0
+        self.cwnd = 10.0
+        self.ssthresh = float(self.max_cwnd)
+        self.recovery = 0.0
+        self.ack_time = 0.0
         self.mtu = 1446  # TODO: review
         self.online = False
         self.transport = None
@@ -49,14 +263,30 @@ class Protocol(asyncio.DatagramProtocol):
         self.guid = GUID.random()
         self.version = 10
         self.read_queue = asyncio.Queue()
+        self.read_time = 0.0
+        self.idle_time = 0.0
+        self.keepalive_time = 0.0
+        self.read_callback = None
+        self.read_callback_idents = frozenset()
         self.read_frame_set_idx = 0
-        self.read_order_idx = 0
-        self.read_order_chan = {}
-        self.read_fragment_chans = collections.defaultdict(dict)
+        self.read_acks = set()
+        self.read_nacks = []
+        self.read_reliable_idx = 0
+        self.read_reliable_indices = set()
+        self.read_order_indices = [0] * 32
+        self.read_order_chans = [{} for _ in range(32)]
+        self.read_sequence_indices = [(0, 0)] * 32
         self.write_offline_task = None
-        self.write_online_tasks = []
+        self.write_queue = collections.deque()
+        self.write_buffer_size = 0
+        self.write_paused = False
+        self.write_drain_waiters = []
+        self.write_timers = []
+        self.write_timer_idx = itertools.count()
+        self.write_reliable_frames = {}
         self.write_reliable_idx = 0
-        self.write_order_idx = 0
+        self.write_order_indices = [0] * 32
+        self.write_sequence_indices = [0] * 32
         self.write_frame_set_idx = 0
         self.write_frame_set_chan = {}
         self.write_fragment_chan = 0
@@ -66,179 +296,586 @@ class Protocol(asyncio.DatagramProtocol):
         self.transport = transport
         self.local_address = Address(family, *transport.get_extra_info('sockname'))
         self.remote_address = Address(family, *transport.get_extra_info('peername'))
-        asyncio.Task(self.tick_forever())
+        self.read_time = self.idle_time = self.ack_time = self.loop.time()
+        self.schedule()
+
+    def connection_lost(self, exc):
+        if exc is not None:
+            self.exception = exc
+        elif self.exception is None:
+            self.exception = ConnectionAbortedError("Connection closed")
+        self.reassembler.discard(self)
+        self.scheduler.cancel(self)
+        self.read_queue.put_nowait(None)
+
+        # Free buffered frames
+        self.write_queue.clear()
+        self.write_timers.clear()
+        self.write_reliable_frames.clear()
+        self.write_frame_set_chan.clear()
+        self.write_buffer_size = 0
+        self.read_reliable_indices.clear()
+        for order_chan in self.read_order_chans:
+            order_chan.clear()
+
+        for waiter in self.write_drain_waiters:
+            if not waiter.done():
+                waiter.set_exception(self.exception)
 
     def datagram_received(self, data, addr=None):
-        buff = io.BytesIO(data)
         ident = data[0]
+        self.read_time = self.loop.time()
 
         if ident & 0xF0 == 0x80:
-            packet = FrameSet.unpack(buff)
+            packet = FrameSet.unpack_from(memoryview(data))
         else:
-            packet = packet_types[ident].unpack(buff)
+            packet = packet_types[ident].unpack_from(data)
 
         if type(packet) in (ACK, NACK):
-            # Find reliable indices from frame set indices
-            reliable_indices = []
-            for frame_set_index in packet.indices:
-                if frame_set_index in self.write_frame_set_chan:
-                    reliable_indices.extend(self.write_frame_set_chan[frame_set_index])
-                    del self.write_frame_set_chan[frame_set_index]
-
-            # Find frames from reliable indices
-            for task in self.write_online_tasks:
-                frame = task.obj
-                if frame.reliable_idx in reliable_indices:
+            rtt = None
+            acked = 0
+            lost = False
+            resend = []
+            for frame_set_idx in self.receipt_indices(packet.ranges):
+                # Find reliable indices from frame set index
+                record = self.write_frame_set_chan.pop(frame_set_idx, None)
+                if record is None:
+                    continue
+                sent, reliable_indices = record
+
+                # Retransmissions go out in new frame sets with their own
+                # indices, so every ACK measures the round trip time
+                if type(packet) is ACK:
+                    acked += 1
+                    rtt = self.loop.time() - sent
+                elif sent >= self.recovery:
+                    lost = True
+
+                # Find frames from reliable indices
+                for reliable_idx in reliable_indices:
+                    frame = self.write_reliable_frames.get(reliable_idx)
+                    if frame is None:
+                        continue
+
                     # ACK: Discard frame
                     if type(packet) is ACK:
-                        task.stop()
+                        frame.acked = True
+                        frame.deadline = None
+                        del self.write_reliable_frames[reliable_idx]
+                        self.write_buffer_size -= len(frame.payload)
+
+                    # NAK: Queue frame for resending now
+                    elif frame.deadline is not None:
+                        frame.deadline = None
+                        resend.append(frame)
 
-                    # NAK: Bring frame to front of queue
-                    else:
-                        task.reset()
+            # Resend ahead of frames not yet sent
+            self.write_queue.extendleft(reversed(resend))
+
+            if rtt is not None:
+                self.update_rto(rtt)
+            self.update_cwnd(acked, lost)
+            self.update_write_buffer()
+            self.schedule()
 
         elif type(packet) is FrameSet:
+            # Withhold the ACK while the reader is behind, so the peer resends later
+            if self.read_queue.qsize() >= self.read_limit:
+                return
+
             for frame in packet.frames:
 
+                # Drop duplicates of reliable frames
+                if frame.reliable:
+                    reliable_idx = frame.reliable_idx
+                    ahead = (reliable_idx - self.read_reliable_idx) & 0xFFFFFF
+                    if ahead >= 0x800000 or reliable_idx in self.read_reliable_indices:
+                        continue
+                    self.read_reliable_indices.add(reliable_idx)
+                    while self.read_reliable_idx in self.read_reliable_indices:
+                        self.read_reliable_indices.remove(self.read_reliable_idx)
+                        self.read_reliable_idx = (self.read_reliable_idx + 1) & 0xFFFFFF
+
                 # Handle fragmentation
                 if frame.fragmented:
-                    fragment_chan = self.read_fragment_chans[frame.fragment_chan]
-                    fragment_chan[frame.fragment_idx] = frame
-                    if len(fragment_chan) != frame.fragment_count:
+                    try:
+                        frame = self.reassembler.add(self, frame, self.loop.time())
+                    except BufferError as exc:
+                        self.abort(ConnectionError(str(exc)))
+                        return
+                    if frame is None:
                         continue
-                    fragments = [fragment_chan[idx] for idx in range(frame.fragment_count)]
-                    fragment_chan.clear()
-                    frame = Frame.from_fragments(fragments)
-
-                # Handle ordering
-                if frame.ordered:
-                    self.read_order_chan[self.read_order_idx] = frame
-                    while self.read_order_idx in self.read_order_chan:
-                        frame = self.read_order_chan.pop(self.read_order_idx)
-                        self.datagram_received(frame.payload)
-                        self.read_order_idx += 1
-                else:
-                    self.datagram_received(frame.payload)
 
-            # Send NAK
-            nak_indices = list(range(self.read_frame_set_idx, packet.idx))
-            if nak_indices:
-                receipt = NACK(indices=nak_indices)
-                self.transport.sendto(receipt.pack())
+                # Handle sequencing: deliver only frames newer than any seen
+                # so far. Sequence indices restart with each ordered frame
+                if frame.sequenced:
+                    order_idx, sequence_idx = self.read_sequence_indices[frame.order_chan]
+                    ahead = (frame.order_idx - order_idx) & 0xFFFFFF
+                    if ahead >= 0x800000:
+                        continue
+                    if not ahead and ((frame.sequence_idx - sequence_idx) & 0xFFFFFF) >= 0x800000:
+                        continue
+                    self.read_sequence_indices[frame.order_chan] = (
+                        frame.order_idx, (frame.sequence_idx + 1) & 0xFFFFFF)
+                    self.frame_received(frame.payload)
+
+                # Handle ordering, independently per channel
+                elif frame.ordered:
+                    order_chan = self.read_order_chans[frame.order_chan]
+                    order_idx = self.read_order_indices[frame.order_chan]
+
+                    # Drop duplicates of frames we've already delivered
+                    ahead = (frame.order_idx - order_idx) & 0xFFFFFF
+                    if ahead >= 0x800000:
+                        continue
 
-            # Send ACK
-            receipt = ACK(indices=[packet.idx])
-            self.transport.sendto(receipt.pack())
+                    # Buffer frames that arrive early
+                    if ahead and type(frame.payload) is memoryview:
+                        frame.payload = bytes(frame.payload)
+                    order_chan[frame.order_idx] = frame
+                    while order_idx in order_chan:
+                        self.frame_received(order_chan.pop(order_idx).payload)
+                        order_idx = (order_idx + 1) & 0xFFFFFF
+                    self.read_order_indices[frame.order_chan] = order_idx
+                else:
+                    self.frame_received(frame.payload)
+
+            # Queue NAKs for skipped frame sets, or cancel one for a late arrival
+            ahead = (packet.idx - self.read_frame_set_idx) & 0xFFFFFF
+            if ahead < 0x800000:
+                if ahead:
+                    self.queue_nacks(self.read_frame_set_idx, ahead)
+                self.read_frame_set_idx = (packet.idx + 1) & 0xFFFFFF
+            else:
+                self.cancel_nack(packet.idx)
 
-            # Update frame set index
-            self.read_frame_set_idx = packet.idx + 1
+            # Queue ACK, sent with the others on the next tick
+            self.read_acks.add(packet.idx)
+            self.schedule()
 
         else:
             self.read_queue.put_nowait(packet)
 
-    async def read(self):
-        return await self.read_queue.get()
+    def receipt_indices(self, ranges):
+        # Frame set indices in flight that a receipt covers. Wide ranges are
+        # matched against the frame sets in flight rather than walked
+        for start, end in ranges:
+            if end - start < len(self.write_frame_set_chan):
+                yield from range(start, end + 1)
+            else:
+                yield from [idx for idx in self.write_frame_set_chan if start <= idx <= end]
+
+    def frame_received(self, payload):
+        if not payload:
+            return
+        ident = payload[0]
+        if ident not in (ConnectedPing.ident, ConnectedPong.ident):
+            self.idle_time = self.read_time
+
+        # Application payloads go straight to the callback, if one is set.
+        # The view may be into a pooled buffer, so must be copied if kept
+        if ident in self.read_callback_idents:
+            if type(payload) is not memoryview:
+                payload = memoryview(payload)
+            self.read_callback(payload)
+        elif ident == Game.ident:
+            self.read_queue.put_nowait(Game(bytes(payload)))
+        elif ident & 0xF0 == 0x80 or ident in (ACK.ident, NACK.ident):
+            return
+        else:
+            packet = packet_types[ident].unpack_from(payload)
+
+            # Answer keepalives, and close when the peer says goodbye
+            if type(packet) is ConnectedPing:
+                self.write(ConnectedPong(
+                    remote_time=packet.local_time,
+                    local_time=int(self.loop.time() * 1000)))
+            elif type(packet) is ConnectedPong:
+                pass
+            elif type(packet) is DisconnectionNotification:
+                self.abort(Disconnected("Disconnected by peer"))
+            else:
+                self.read_queue.put_nowait(packet)
 
-    def write(self, packet):
+    def set_read_callback(self, callback, idents=(Game.ident,)):
+        # Deliver payloads with these idents to callback(payload) instead of read()
+        self.read_callback = callback
+        self.read_callback_idents = frozenset(idents) if callback else frozenset()
+
+    async def read(self):
+        packet = await self.read_queue.get()
+        if packet is None:
+            self.read_queue.put_nowait(None)
+            raise self.exception
+        return packet
+
+    async def read_many(self, max_count=None):
+        # Waits for a packet, then returns it with any others already received
+        packets = [await self.read()]
+        while not self.read_queue.empty() and (max_count is None or len(packets) < max_count):
+            packet = self.read_queue.get_nowait()
+            if packet is None:
+                self.read_queue.put_nowait(None)
+                break
+            packets.append(packet)
+        return packets
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.read()
+        except (ConnectionAbortedError, Disconnected):
+            raise StopAsyncIteration
+
+    def write(self, packet, channel=0, reliability=None):
         data = packet.pack()
 
         # Set offline task if we're offline
         if not self.online:
-            self.write_offline_task = Task(data, ticks=20, retries=5)
+            self.write_offline_task = Task(data, interval=1.0, retries=5)
+            self.schedule()
             return
 
-        frames = []
-        mtu = self.mtu - 60
+        if data[0] not in (ConnectedPing.ident, ConnectedPong.ident):
+            self.idle_time = self.loop.time()
+
+        # Evil hack: send pings/pongs as unreliable + unordered!
+        # Otherwise send reliable + ordered unless told otherwise
+        if reliability is None:
+            reliability = UNRELIABLE if data[0] in (0, 3) else RELIABLE_ORDERED
+
+        # Room for frames in a datagram, less IP and UDP headers
+        limit = self.mtu - 28 - FrameSet.header_size
+
+        # Split packets must be reliable
+        receipt, reliable, sequenced, ordered = reliability_types[reliability]
+        assert not receipt
+        fragmented = len(data) + Frame.header_length(reliable, sequenced, ordered, False) > limit
+        if fragmented:
+            reliability = {
+                UNRELIABLE: RELIABLE,
+                UNRELIABLE_SEQUENCED: RELIABLE_SEQUENCED}.get(reliability, reliability)
+            receipt, reliable, sequenced, ordered = reliability_types[reliability]
+
+        # Sequenced frames carry the channel's current order index; ordered
+        # frames advance it and restart the sequence
+        order_idx = None
+        sequence_idx = None
+        if sequenced:
+            order_idx = self.write_order_indices[channel]
+            sequence_idx = self.write_sequence_indices[channel]
+            self.write_sequence_indices[channel] = (sequence_idx + 1) & 0xFFFFFF
+        elif ordered:
+            order_idx = self.write_order_indices[channel]
+            self.write_order_indices[channel] = (order_idx + 1) & 0xFFFFFF
+            self.write_sequence_indices[channel] = 0
+
+        # Split the payload into fragments if needed, each filling a datagram
+        if fragmented:
+            size = limit - Frame.header_length(reliable, sequenced, ordered, True)
+            view = memoryview(data)
+            fragments = [view[offset:offset + size] for offset in range(0, len(data), size)]
+        else:
+            fragments = [data]
 
-        # Simple case: no need to fragment
-        if len(data) <= mtu:
-            # Evil hack: send pings/pongs as unreliable + unordered!
-            if data[0] in (0, 3):
-                frames.append(Frame(data))
+        frames = []
+        for fragment_idx, fragment in enumerate(fragments):
+            frames.append(Frame(
+                payload=fragment,
+                reliable_idx=self.write_reliable_idx if reliable else None,
+                order_idx=order_idx,
+                fragment_idx=fragment_idx if fragmented else None,
+                fragment_count=len(fragments) if fragmented else None,
+                fragment_chan=self.write_fragment_chan if fragmented else None,
+                order_chan=channel,
+                sequence_idx=sequence_idx))
+            if reliable:
+                self.write_reliable_idx += 1
+        if fragmented:
+            self.write_fragment_chan = (self.write_fragment_chan + 1) % 32
 
-            # Otherwise send reliable + ordered
+        # Queue each frame
+        for frame in frames:
+            self.write_queue.append(frame)
+            self.write_buffer_size += len(frame.payload)
+            if frame.reliable:
+                self.write_reliable_frames[frame.reliable_idx] = frame
+        self.update_write_buffer()
+        self.schedule()
+
+    def write_threadsafe(self, packet, channel=0, reliability=None):
+        # Lets sessions served by other threads' loops write to this one
+        self.loop.call_soon_threadsafe(self.write, packet, channel, reliability)
+
+    def get_write_buffer_size(self):
+        # Bytes queued or awaiting acknowledgement
+        return self.write_buffer_size
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        if high is None:
+            high = self.high_water if low is None else 4 * low
+        if low is None:
+            low = high // 4
+        assert 0 <= low <= high
+        self.high_water = high
+        self.low_water = low
+        self.update_write_buffer()
+
+    def update_write_buffer(self):
+        if not self.write_paused and self.write_buffer_size > self.high_water:
+            self.write_paused = True
+            self.write_buffer_full()
+        elif self.write_paused and self.write_buffer_size <= self.low_water:
+            self.write_paused = False
+            for waiter in self.write_drain_waiters:
+                if not waiter.done():
+                    waiter.set_result(None)
+            self.write_buffer_drained()
+
+    def write_buffer_full(self):
+        # Called when the write buffer goes over the high watermark. Named
+        # apart from pause_writing(), which the socket's transport calls
+        pass
+
+    def write_buffer_drained(self):
+        # Called when the write buffer drains to the low watermark
+        pass
+
+    async def drain(self):
+        if self.transport is not None and self.transport.is_closing():
+            raise self.exception or ConnectionAbortedError("Connection closed")
+        if not self.write_paused:
+            return
+        waiter = self.loop.create_future()
+        self.write_drain_waiters.append(waiter)
+        try:
+            await waiter
+        finally:
+            self.write_drain_waiters.remove(waiter)
+
+    def update_rto(self, rtt):
+        # Smoothed round trip time and variance, as RFC 6298
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        rto = self.srtt + max(self.scheduler.interval, 4 * self.rttvar)
+        self.rto = min(max(rto, self.min_rto), self.max_rto)
+
+    def update_cwnd(self, acked, lost):
+        now = self.loop.time()
+
+        if acked:
+            self.ack_time = now
+
+        # Halve the window on loss. Callers only count frame sets sent since
+        # the last cut, so this happens at most once per round trip. Start
+        # over only if a whole RTO went by without anything acknowledged
+        if lost:
+            self.ssthresh = max(self.cwnd / 2, self.min_cwnd)
+            if now - self.ack_time >= self.rto:
+                self.cwnd = self.min_cwnd
             else:
-                frames.append(Frame(
-                    payload=data,
-                    reliable_idx=self.write_reliable_idx,
-                    order_idx=self.write_order_idx))
-                self.write_reliable_idx += 1
-                self.write_order_idx += 1
+                self.cwnd = self.ssthresh
+            self.recovery = now
 
-        # Otherwise split the payload into fragments
+        # Grow exponentially in slow start, then linearly
+        elif self.cwnd < self.ssthresh:
+            self.cwnd += acked
         else:
-            # Split
-            fragments = []
-            while data:
-                fragments.append(data[:mtu])
-                data = data[mtu:]
-
-            # Send fragments ordered + reliable
-            for fragment_idx, fragment in enumerate(fragments):
-                frame = Frame(
-                    payload=fragment,
-                    reliable_idx=self.write_reliable_idx,
-                    order_idx=self.write_order_idx,
-                    fragment_idx=fragment_idx,
-                    fragment_count=len(fragments),
-                    fragment_chan=self.write_fragment_chan)
-                frames.append(frame)
-                self.write_reliable_idx += 1
-            self.write_fragment_chan = (self.write_fragment_chan + 1) % 32
-            self.write_order_idx += 1
+            self.cwnd += acked / self.cwnd
+        self.cwnd = min(self.cwnd, self.max_cwnd)
 
-        # Queue a task for each frame
-        for frame in frames:
-            retries = 5 if frame.reliable else 0
-            self.write_online_tasks.append(Task(frame, ticks=20, retries=retries))
+    def abort(self, exc):
+        self.exception = exc
+        self.transport.abort()
 
-    def tick(self):
-        # Tick/run offline task if we're offline
+    def schedule(self):
+        # Drop timers left behind by acknowledged or requeued frames
+        while self.write_timers and self.write_timers[0][2].deadline != self.write_timers[0][0]:
+            heapq.heappop(self.write_timers)
+
+        # Ask the scheduler to tick us when we next have something to do
         if not self.online:
-            if self.write_offline_task and self.write_offline_task.alive:
-                if self.write_offline_task.active:
-                    self.transport.sendto(self.write_offline_task.obj)
-                self.write_offline_task.tick()
+            task = self.write_offline_task
+            if task and task.alive:
+                self.scheduler.schedule(self, task.deadline or self.loop.time())
+        elif self.write_queue or self.read_acks or self.read_nacks:
+            self.scheduler.schedule(self, self.loop.time())
+        elif self.write_timers:
+            self.scheduler.schedule(self, min(self.write_timers[0][0], self.keepalive_deadline()))
+        else:
+            self.scheduler.schedule(self, self.keepalive_deadline())
+
+    def keepalive_deadline(self):
+        # When we next need to ping the peer, or give up on it
+        deadline = min(
+            max(self.read_time, self.keepalive_time) + self.keepalive_interval,
+            self.read_time + self.timeout)
+        if self.idle_timeout is not None:
+            deadline = min(deadline, self.idle_time + self.idle_timeout)
+        return deadline
+
+    def keepalive(self, now):
+        # Returns False if the session was closed
+        if now - self.read_time >= self.timeout:
+            self.abort(TimeoutError("No data from peer in %.1fs" % self.timeout))
+            return False
+        if self.idle_timeout is not None and now - self.idle_time >= self.idle_timeout:
+            self.abort(TimeoutError("Idle for %.1fs" % self.idle_timeout))
+            return False
+        if now - max(self.read_time, self.keepalive_time) >= self.keepalive_interval:
+            self.keepalive_time = now
+            self.write(ConnectedPing(local_time=int(now * 1000)))
+        return True
+
+    def queue_nacks(self, start, count):
+        # Pending NAKs are kept as sorted ranges that don't wrap, so a long
+        # gap costs no more than a short one
+        end = start + count - 1
+        if end > 0xFFFFFF:
+            bisect.insort(self.read_nacks, (start, 0xFFFFFF))
+            start, end = 0, end & 0xFFFFFF
+        bisect.insort(self.read_nacks, (start, end))
+
+    def cancel_nack(self, idx):
+        # Split the range holding a frame set that arrived late
+        i = bisect.bisect_right(self.read_nacks, (idx, 0xFFFFFF)) - 1
+        if i < 0 or self.read_nacks[i][1] < idx:
+            return
+        start, end = self.read_nacks[i]
+        self.read_nacks[i:i + 1] = [(a, b) for a, b in ((start, idx - 1), (idx + 1, end)) if a <= b]
+
+    def send_receipts(self, cls, ranges):
+        # Split into as many datagrams as it takes to stay within the MTU
+        limit = self.mtu - 28
+        receipt = []
+        size = cls.header_size
+        for start, end in ranges:
+            range_size = cls.range_size(start, end)
+            if receipt and size + range_size > limit:
+                self.transport.sendto(cls(receipt).pack())
+                receipt = []
+                size = cls.header_size
+            receipt.append((start, end))
+            size += range_size
+        if receipt:
+            self.transport.sendto(cls(receipt).pack())
+
+    def tick(self, now=None):
+        if now is None:
+            now = self.loop.time()
+
+        # Run offline task if we're offline
+        if not self.online:
+            task = self.write_offline_task
+            if task and task.alive and task.due(now):
+                self.transport.sendto(task.obj)
+                task.retries -= 1
+                task.deadline = now + task.interval
+            self.schedule()
             return
 
-        # Tick online tasks and find active frames
-        frames = []
-        tasks = []
-        for task in self.write_online_tasks:
-            if task.alive:
-                if task.active:
-                    frames.append(task.obj)
-                task.tick()
-                tasks.append(task)
-        self.write_online_tasks[:] = tasks
-
-        # Combine frames into frame sets
-        while frames:
-            frame_set = FrameSet(self.write_frame_set_idx, [])
-            frame_set_size = len(frame_set.pack())
+        self.reassembler.expire(self, now)
+        if not self.keepalive(now):
+            return
+
+        # Send receipts for frame sets received since the last tick
+        if self.read_acks:
+            self.send_receipts(ACK, ACK.collapse(sorted(self.read_acks)))
+            self.read_acks.clear()
+        if self.read_nacks:
+            self.send_receipts(NACK, self.read_nacks)
+            self.read_nacks.clear()
+
+        # Requeue reliable frames whose retransmission deadline has passed,
+        # ahead of frames not yet sent
+        expired = []
+        lost = False
+        backoff = False
+        while self.write_timers and self.write_timers[0][0] <= now:
+            deadline, _, frame = heapq.heappop(self.write_timers)
+            if frame.deadline != deadline:
+                continue
+            if now - frame.sent >= self.timeout:
+                self.abort(TimeoutError("No acknowledgement from peer in %.1fs" % self.timeout))
+                return
+            frame.deadline = None
+            record = self.write_frame_set_chan.pop(frame.frame_set_idx, None)
+            if record is not None:
+                lost = lost or record[0] >= self.recovery
+                backoff = backoff or record[0] >= self.backoff_time
+            expired.append(frame)
+        self.write_queue.extendleft(reversed(expired))
+
+        # Shrink the window, as for NAKs
+        if lost:
+            self.update_cwnd(0, True)
+
+        # Back off once per RTO: only frames sent since the last backoff,
+        # whose deadlines used the current RTO, count towards another
+        if backoff:
+            self.rto = min(self.rto * 2, self.max_rto)
+            self.backoff_time = self.loop.time()
+
+        # Work out how many frame sets the congestion window and pacing allow
+        budget = int(self.cwnd) - len(self.write_frame_set_chan)
+        if self.srtt:
+            budget = min(budget, max(1, math.ceil(self.cwnd * self.scheduler.interval / self.srtt)))
+
+        # Combine queued frames into frame sets
+        limit = self.mtu - 28
+        sent = self.loop.time()
+        while self.write_queue and budget > 0:
+            # Frame set indices are 24-bit on the wire, so wrap them here too
+            frame_set_idx = self.write_frame_set_idx & 0xFFFFFF
+            frame_set = FrameSet(frame_set_idx, [])
+            frame_set_size = FrameSet.header_size
             reliable_indices = []
-            while frames:
-                frame = frames.pop(0)
-                frame_size = len(frame.pack())
+            while self.write_queue:
+                frame = self.write_queue[0]
+                if frame.acked:
+                    self.write_queue.popleft()
+                    continue
+                frame_size = frame.size
 
                 # Full frame set?
-                if (frame_set_size + frame_size) > (self.mtu - 28):
+                if frame_set.frames and (frame_set_size + frame_size) > limit:
                     break
 
                 # Add the frame
+                self.write_queue.popleft()
                 frame_set.frames.append(frame)
                 frame_set_size += frame_size
+                if not frame.reliable:
+                    self.write_buffer_size -= len(frame.payload)
+                if frame.sent is None:
+                    frame.sent = sent
+
+                # Set retransmission deadline
                 if frame.reliable:
                     reliable_indices.append(frame.reliable_idx)
-
-            # Record reliable indices for ACKs/NAKs
-            self.write_frame_set_chan[self.write_frame_set_idx] = reliable_indices
-            self.write_frame_set_idx += 1
-
-            # Send the frame set
-            self.transport.sendto(frame_set.pack())
-
-    async def tick_forever(self):
-        while not self.transport.is_closing():
-            self.tick()
-            await asyncio.sleep(0.05)
+                    frame.frame_set_idx = frame_set_idx
+                    frame.deadline = min(now + self.rto, frame.sent + self.timeout)
+                    heapq.heappush(self.write_timers, (frame.deadline, next(self.write_timer_idx), frame))
+
+            if not frame_set.frames:
+                break
+
+            # Record send time and reliable indices for ACKs/NAKs
+            if reliable_indices:
+                self.write_frame_set_chan[frame_set_idx] = (sent, reliable_indices)
+            self.write_frame_set_idx = (frame_set_idx + 1) & 0xFFFFFF
+            budget -= 1
+
+            # Write the frame set into a buffer of its exact size and send it
+            buff = bytearray(frame_set_size)
+            frame_set.pack_into(buff)
+            self.transport.sendto(buff)
+
+        self.update_write_buffer()
+        self.schedule()
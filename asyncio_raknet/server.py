@@ -1,33 +1,189 @@
 import asyncio
 
+from asyncio_raknet import linux
 from asyncio_raknet.packets import *
-from asyncio_raknet.protocol import Protocol
+from asyncio_raknet.protocol import Protocol, Reassembler, Scheduler
+
+
+# Where magic sits in each packet the server answers without a session
+offline_magic_offsets = {
+    UnconnectedPing.ident: 9,
+    UnconnectedPingOpenConnections.ident: 9,
+    OpenConnectionRequest1.ident: 1,
+    OpenConnectionRequest2.ident: 1,
+}
 
 
 class Server(asyncio.DatagramProtocol, asyncio.AbstractServer):
-    def __init__(self, conn_callback):
+    max_status_waiters = 1024
+
+    def __init__(self, conn_callback, status_callback, batch=True, status_ttl=5.0,
+                 lost_callback=None, idle_timeout=None, timeout=10.0):
+        self.loop = asyncio.get_event_loop()
         self.conn_callback = conn_callback
+        self.status_callback = status_callback
+        self.lost_callback = lost_callback
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.status_ttl = status_ttl
+        self.status_pong = None
+        self.status_expires = 0.0
+        self.status_task = None
+        self.status_waiters = []
+        self.guid = GUID.random()
         self.transport = None
         self.protocols = {}
-        self.close_future = asyncio.get_event_loop().create_future()
+        self.scheduler = Scheduler()
+        self.reassembler = Reassembler()
+        self.batch = batch and linux.available
+        self.sender = None
+        self.send_queue = []
+        self.receiver = None
+        self.close_future = self.loop.create_future()
 
     def connection_made(self, transport):
         self.transport = transport
+        if self.batch:
+            sock = transport.get_extra_info('socket')
+            self.sender = linux.Sender(sock)
+            self.receiver = linux.Receiver(sock)
+            transport.pause_reading()
+            self.loop.add_reader(self.receiver.fileno(), self.read_ready)
 
     def connection_lost(self, exc):
+        for protocol in list(self.protocols.values()):
+            protocol.transport.close()
+        if self.receiver is not None:
+            self.loop.remove_reader(self.receiver.fileno())
+            self.receiver.close()
+        self.scheduler.close()
         self.close_future.set_result(None)
 
+    def read_ready(self):
+        # Received data lives in pooled buffers, so it must be copied if kept
+        try:
+            datagrams = self.receiver.receive()
+        except OSError as exc:
+            self.error_received(exc)
+            return
+        # A bad datagram mustn't lose the rest of the batch
+        for data, addr in datagrams:
+            try:
+                self.datagram_received(data, addr)
+            except Exception as exc:
+                self.loop.call_exception_handler({
+                    'message': 'Exception in datagram_received',
+                    'exception': exc,
+                    'protocol': self,
+                })
+
     def datagram_received(self, data, addr):
         protocol = self.protocols.get(addr)
-        if protocol is None:
-            if magic not in data:
-                return
-            protocol = Protocol()
-            transport = ServerTransport(self, protocol, addr)
-            protocol.connection_made(transport)
-            self.protocols[addr] = protocol
-            asyncio.Task(self.conn_callback(protocol))
-        protocol.datagram_received(data)
+        if protocol is None or data[0] in offline_magic_offsets:
+            self.offline_received(data, addr, protocol)
+        else:
+            protocol.datagram_received(data)
+
+    def offline_received(self, data, addr, protocol):
+        # Answer pings and the first handshake step without a session
+        offset = offline_magic_offsets.get(data[0])
+        if offset is None or data[offset:offset + 16] != magic:
+            return
+        if offset == 9:
+            self.ping_received(data[1:9], addr)
+            return
+        try:
+            packet = packet_types[data[0]].unpack_from(data)
+        except Exception:
+            return
+
+        if type(packet) is OpenConnectionRequest1:
+            self.sendto(OpenConnectionReply1(
+                guid=self.guid,
+                mtu=packet.mtu,
+                security=False).pack(), addr)
+        elif type(packet) is OpenConnectionRequest2:
+            # Create the session, unless this is a resend whose reply was lost
+            if protocol is None:
+                protocol = Protocol(self.scheduler, timeout=self.timeout, reassembler=self.reassembler,
+                                    idle_timeout=self.idle_timeout)
+                protocol.guid = self.guid
+                protocol.mtu = packet.mtu
+                protocol.connection_made(ServerTransport(self, protocol, addr))
+                protocol.online = True
+                protocol.schedule()
+                self.protocols[addr] = protocol
+                asyncio.Task(self.conn_callback(protocol))
+            self.sendto(OpenConnectionReply2(
+                guid=self.guid,
+                mtu=protocol.mtu,
+                remote_address=protocol.remote_address,
+                encryption=False).pack(), addr)
+
+    def ping_received(self, timestamp, addr):
+        # Answer from the cached pong, refreshing it in the background once
+        # stale. Pings wait only if there's nothing cached yet
+        if self.status_task is None and self.loop.time() >= self.status_expires:
+            self.status_task = self.loop.create_task(self.update_status())
+        if self.status_pong is None:
+            if len(self.status_waiters) < self.max_status_waiters:
+                self.status_waiters.append((bytes(timestamp), addr))
+            return
+        self.send_pong(timestamp, addr)
+
+    def send_pong(self, timestamp, addr):
+        # The pong echoes the ping's timestamp at bytes 1-9
+        pong = bytearray(self.status_pong)
+        pong[1:9] = timestamp
+        self.sendto(pong, addr)
+
+    async def update_status(self):
+        try:
+            status = await self.status_callback()
+        finally:
+            self.status_task = None
+        self.status_pong = UnconnectedPong(guid=self.guid, remote_time=0, status=status).pack()
+        self.status_expires = self.loop.time() + self.status_ttl
+        waiters, self.status_waiters = self.status_waiters, []
+        if not self.transport.is_closing():
+            for timestamp, addr in waiters:
+                self.send_pong(timestamp, addr)
+
+    def invalidate_status(self):
+        # Pings wait for a fresh status rather than getting the cached one
+        self.status_pong = None
+        self.status_expires = 0.0
+
+    def sendto(self, data, addr):
+        if self.sender is None:
+            self.transport.sendto(data, addr)
+            return
+
+        # Queue the datagram and flush everything sent this loop iteration at once
+        if not self.send_queue:
+            self.loop.call_soon(self.flush)
+        self.send_queue.append((data, addr))
+
+    def flush(self):
+        datagrams, self.send_queue = self.send_queue, []
+        if self.transport.is_closing():
+            return
+
+        # Send in batches, unless the transport is already buffering
+        sent = 0
+        if not self.transport.get_write_buffer_size():
+            while sent < len(datagrams):
+                try:
+                    count = self.sender.send(datagrams[sent:])
+                except OSError:
+                    break
+                if not count:
+                    break
+                sent += count
+
+        # Leave anything left over to the transport
+        for data, addr in datagrams[sent:]:
+            self.transport.sendto(data, addr)
 
     def close(self):
         self.transport.close()
@@ -66,48 +222,23 @@ class ServerTransport(asyncio.DatagramTransport):
             self.closed = True
             self.protocol.connection_lost(None)
             del self.server.protocols[self.addr]
+            if self.server.lost_callback is not None:
+                self.server.lost_callback(self.protocol, self.protocol.exception)
 
     def sendto(self, data, addr=None):
-        self.server.transport.sendto(data, self.addr)
+        self.server.sendto(data, self.addr)
 
     def abort(self):
         self.close()
 
 
-async def listen(host, port, status_callback, login_callback, **kwargs):
-
-    async def handler(protocol):
-        while True:
-            packet = await protocol.read()
-            if type(packet) in (UnconnectedPing, UnconnectedPingOpenConnections):
-                status = await status_callback(protocol)
-                protocol.write(UnconnectedPong(
-                    guid=protocol.guid,
-                    remote_time=packet.local_time,
-                    status=status))
-            elif type(packet) is OpenConnectionRequest1:
-                protocol.mtu = packet.mtu
-                protocol.version = packet.version
-                protocol.write(OpenConnectionReply1(
-                    guid=protocol.guid,
-                    mtu=protocol.mtu,
-                    security=False))
-            elif type(packet) is OpenConnectionRequest2:
-                protocol.mtu = packet.mtu
-                protocol.write(OpenConnectionReply2(
-                    guid=protocol.guid,
-                    mtu=protocol.mtu,
-                    remote_address=protocol.remote_address,
-                    encryption=False))
-                protocol.tick()
-                protocol.online = True
-                break
-            else:
-                raise ValueError(packet)
-
-        await login_callback(protocol)
-
+async def listen(host, port, status_callback, login_callback, batch=True, status_ttl=5.0,
+                 lost_callback=None, idle_timeout=None, timeout=10.0, **kwargs):
+    # status_callback() is awaited for the ping status at most every
+    # status_ttl seconds; login_callback(protocol) for each session, once
+    # the handshake is done; lost_callback(protocol, exc) as each closes.
+    # Sessions time out after timeout seconds without hearing from the peer
     loop = asyncio.get_event_loop()
-    server = Server(handler)
+    server = Server(login_callback, status_callback, batch, status_ttl, lost_callback, idle_timeout, timeout)
     await loop.create_datagram_endpoint(lambda: server, local_addr=(host, port), **kwargs)
     return server
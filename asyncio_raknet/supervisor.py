@@ -0,0 +1,218 @@
+import asyncio
+import multiprocessing
+import os
+import threading
+
+from asyncio_raknet import linux
+from asyncio_raknet.server import listen
+
+
+async def worker(conn, idx, count, host, port, status_callback, login_callback, bpf, kwargs):
+    loop = asyncio.get_running_loop()
+    server = await listen(host, port, status_callback, login_callback, reuse_port=True, **kwargs)
+    if bpf:
+        linux.attach_reuseport_cbpf(server.transport.get_extra_info('socket'), count)
+
+    # Stop when asked to, or when the supervisor goes away
+    def command():
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            message = 'close'
+        if message == 'close' and server.is_serving():
+            server.close()
+    loop.add_reader(conn.fileno(), command)
+
+    # Report our session count until we're closed
+    while server.is_serving():
+        try:
+            conn.send(len(server.protocols))
+        except OSError:
+            server.close()
+            break
+        try:
+            await asyncio.wait_for(asyncio.shield(server.wait_closed()), 1.0)
+        except asyncio.TimeoutError:
+            pass
+
+    loop.remove_reader(conn.fileno())
+    await server.wait_closed()
+
+
+def run_worker(*args):
+    asyncio.run(worker(*args))
+
+
+class Supervisor(object):
+    def __init__(self, host, port, status_callback, login_callback, workers=None, bpf=False, **kwargs):
+        self.loop = asyncio.get_event_loop()
+        self.host = host
+        self.port = port
+        self.status_callback = status_callback
+        self.login_callback = login_callback
+        self.count = workers or os.cpu_count()
+        self.bpf = bpf and linux.available
+        self.kwargs = kwargs
+        self.processes = []
+        self.conns = []
+        self.sessions = [0] * self.count
+        self.alive = set()
+        self.close_future = self.loop.create_future()
+
+    def start(self):
+        # Callbacks are passed to the workers as-is, so with a non-fork start
+        # method they must be picklable
+        for idx in range(self.count):
+            conn, child_conn = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=run_worker,
+                args=(child_conn, idx, self.count, self.host, self.port,
+                      self.status_callback, self.login_callback, self.bpf, self.kwargs),
+                daemon=True)
+            process.start()
+            child_conn.close()
+            self.processes.append(process)
+            self.conns.append(conn)
+            self.alive.add(idx)
+            self.loop.add_reader(conn.fileno(), self.status_received, idx)
+            self.loop.add_reader(process.sentinel, self.worker_exited, idx)
+
+    def status_received(self, idx):
+        conn = self.conns[idx]
+        try:
+            self.sessions[idx] = conn.recv()
+        except (EOFError, OSError):
+            self.loop.remove_reader(conn.fileno())
+
+    def worker_exited(self, idx):
+        self.loop.remove_reader(self.processes[idx].sentinel)
+        self.processes[idx].join()
+        self.sessions[idx] = 0
+        self.alive.discard(idx)
+        if not self.alive:
+            for conn in self.conns:
+                self.loop.remove_reader(conn.fileno())
+                conn.close()
+            if not self.close_future.done():
+                self.close_future.set_result(None)
+
+    def status(self):
+        return {
+            'workers': len(self.alive),
+            'sessions': sum(self.sessions)}
+
+    def close(self):
+        for conn in self.conns:
+            try:
+                conn.send('close')
+            except OSError:
+                pass
+
+    def is_serving(self):
+        return not self.close_future.done()
+
+    async def serve_forever(self):
+        await self.wait_closed()
+
+    async def wait_closed(self, timeout=None):
+        try:
+            await asyncio.wait_for(asyncio.shield(self.close_future), timeout)
+        except asyncio.TimeoutError:
+            for process in self.processes:
+                process.terminate()
+            await self.close_future
+
+
+async def listen_workers(host, port, status_callback, login_callback, workers=None, bpf=False, **kwargs):
+    supervisor = Supervisor(host, port, status_callback, login_callback, workers, bpf, **kwargs)
+    supervisor.start()
+    return supervisor
+
+
+class ThreadSupervisor(object):
+    def __init__(self, host, port, status_callback, login_callback, threads=None, bpf=False, **kwargs):
+        self.loop = asyncio.get_event_loop()
+        self.host = host
+        self.port = port
+        self.status_callback = status_callback
+        self.login_callback = login_callback
+        self.count = threads or os.cpu_count()
+        self.bpf = bpf and linux.available
+        self.kwargs = kwargs
+        self.threads = []
+        self.servers = [None] * self.count
+        self.alive = set()
+        self.close_future = self.loop.create_future()
+
+    async def start(self):
+        started = []
+        for idx in range(self.count):
+            future = self.loop.create_future()
+            thread = threading.Thread(target=self.run, args=(idx, future), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+            self.alive.add(idx)
+            started.append(future)
+        # Wait for every thread before closing, so none is left serving
+        results = await asyncio.gather(*started, return_exceptions=True)
+        errors = [result for result in results if isinstance(result, BaseException)]
+        if errors:
+            self.close()
+            raise errors[0]
+
+    def run(self, idx, started):
+        try:
+            asyncio.run(self.serve(idx, started))
+        finally:
+            self.loop.call_soon_threadsafe(self.thread_exited, idx)
+
+    async def serve(self, idx, started):
+        # Runs in its own thread and loop, with its own socket and sessions
+        try:
+            server = await listen(self.host, self.port, self.status_callback, self.login_callback,
+                                  reuse_port=True, **self.kwargs)
+            if self.bpf:
+                linux.attach_reuseport_cbpf(server.transport.get_extra_info('socket'), self.count)
+        except Exception as exc:
+            self.loop.call_soon_threadsafe(started.set_exception, exc)
+            return
+        self.servers[idx] = server
+        self.loop.call_soon_threadsafe(started.set_result, None)
+        await server.wait_closed()
+
+    def thread_exited(self, idx):
+        self.threads[idx].join()
+        self.alive.discard(idx)
+        if not self.alive and not self.close_future.done():
+            self.close_future.set_result(None)
+
+    def status(self):
+        return {
+            'threads': len(self.alive),
+            'sessions': sum(len(self.servers[idx].protocols) for idx in self.alive if self.servers[idx])}
+
+    def close(self):
+        # Skip threads that have exited, whose loops are closed
+        for idx in list(self.alive):
+            server = self.servers[idx]
+            if server is None:
+                continue
+            try:
+                server.loop.call_soon_threadsafe(server.close)
+            except RuntimeError:
+                pass
+
+    def is_serving(self):
+        return not self.close_future.done()
+
+    async def serve_forever(self):
+        await self.wait_closed()
+
+    async def wait_closed(self):
+        await self.close_future
+
+
+async def listen_threads(host, port, status_callback, login_callback, threads=None, bpf=False, **kwargs):
+    supervisor = ThreadSupervisor(host, port, status_callback, login_callback, threads, bpf, **kwargs)
+    await supervisor.start()
+    return supervisor
@@ -1,3 +1,4 @@
+import io
 import os
 import socket
 import struct
@@ -7,6 +8,10 @@ magic = b'\x00\xff\xff\x00' \
         b'\xfd\xfd\xfd\xfd' \
         b'\x12\x34\x56\x78'
 
+struct_uint16 = struct.Struct('>H')
+struct_uint32 = struct.Struct('>I')
+struct_uint64 = struct.Struct('>Q')
+
 
 class Underrun(Exception):
     pass
@@ -36,11 +41,11 @@ def pack_uint8(val):
 
 
 def unpack_uint16(buff):
-    return struct.unpack('>H', unpack_bytes(buff, 2))[0]
+    return struct_uint16.unpack(unpack_bytes(buff, 2))[0]
 
 
 def pack_uint16(val):
-    return struct.pack('>H', val)
+    return struct_uint16.pack(val)
 
 
 def unpack_uint24le(buff):
@@ -48,36 +53,48 @@ def unpack_uint24le(buff):
     return data[0] + (data[1] << 8) + (data[2] << 16)
 
 
+def unpack_uint24le_from(view, offset):
+    return view[offset] + (view[offset + 1] << 8) + (view[offset + 2] << 16)
+
+
 def pack_uint24le(val):
     return bytes([0xFF & val, 0xFF & (val >> 8), 0xFF & (val >> 16)])
 
 
 def unpack_uint32(buff):
-    return struct.unpack('>I', unpack_bytes(buff, 4))[0]
+    return struct_uint32.unpack(unpack_bytes(buff, 4))[0]
 
 
 def pack_uint32(val):
-    return struct.pack('>I', val)
+    return struct_uint32.pack(val)
 
 
 def unpack_uint64(buff):
-    return struct.unpack('>Q', unpack_bytes(buff, 8))[0]
+    return struct_uint64.unpack(unpack_bytes(buff, 8))[0]
 
 
 def pack_uint64(val):
-    return struct.pack('>Q', val)
+    return struct_uint64.pack(val)
 
 
 class Serializable(object):
+    __slots__ = ()
+
     @classmethod
     def unpack(cls, buff):
         raise NotImplementedError
 
+    @classmethod
+    def unpack_from(cls, view):
+        return cls.unpack(io.BytesIO(view))
+
     def pack(self):
         raise NotImplementedError
 
 
 class GUID(Serializable):
+    __slots__ = ('value',)
+
     def __init__(self, value):
         self.value = value
 
@@ -94,6 +111,8 @@ class GUID(Serializable):
 
 
 class Address(Serializable):
+    __slots__ = ('family', 'host', 'port')
+
     def __init__(self, family, host, port):
         self.family = family
         self.host = host
@@ -106,6 +125,26 @@ class Address(Serializable):
     def empty(cls):
         return cls(socket.AF_INET, '255.255.255.255', 0)
 
+    @classmethod
+    def unpack_from(cls, view, offset):
+        # Returns the address and the offset just past it
+        version = view[offset]
+        assert version in (4, 6)
+        if version == 4:
+            if offset + 7 > len(view):
+                raise Underrun()
+            family = socket.AF_INET
+            host = socket.inet_ntop(family, view[offset + 1:offset + 5])
+            port = struct_uint16.unpack_from(view, offset + 5)[0]
+            return cls(family, host, port), offset + 7
+        else:
+            if offset + 29 > len(view):
+                raise Underrun()
+            family = socket.AF_INET6
+            port = struct_uint16.unpack_from(view, offset + 3)[0]
+            host = socket.inet_ntop(family, view[offset + 9:offset + 25])
+            return cls(family, host, port), offset + 29
+
     @classmethod
     def unpack(cls, buff):
         version = unpack_uint8(buff)